@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
-import json
 import os
 import time
 from pathlib import Path
 
+import orjson
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session():
+    # 429 is left to the polling loop, which owns the device-flow cadence.
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET", "POST"),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = make_session()
 
 
 def env(name, default=None, required=False):
@@ -15,10 +35,25 @@ def env(name, default=None, required=False):
     return val
 
 
+def write_atomic(path: Path, payload: bytes):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
 def save_token(path: Path, data: dict):
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, sort_keys=True)
+    write_atomic(path, orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+
+
+def error_message(resp):
+    try:
+        return orjson.loads(resp.content).get("message", "")
+    except ValueError:
+        return ""
 
 
 def main():
@@ -27,13 +62,13 @@ def main():
     scopes = env("TWITCH_SCOPES", default="")
     token_path = Path(env("TOKEN_PATH", default="twitch_token.json"))
 
-    device_resp = requests.post(
+    device_resp = SESSION.post(
         "https://id.twitch.tv/oauth2/device",
         data={"client_id": client_id, "scopes": scopes},
         timeout=30,
     )
     device_resp.raise_for_status()
-    device_data = device_resp.json()
+    device_data = orjson.loads(device_resp.content)
 
     print("Go to:", device_data["verification_uri"])
     print("Enter code:", device_data["user_code"])
@@ -42,10 +77,17 @@ def main():
     interval = max(1, int(device_data.get("interval", 5)))
     device_code = device_data["device_code"]
     token_url = "https://id.twitch.tv/oauth2/token"
+    deadline = time.monotonic() + int(device_data.get("expires_in", 1800))
+    next_poll = time.monotonic() + interval
 
     while True:
-        time.sleep(interval)
-        token_resp = requests.post(
+        delay = next_poll - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if time.monotonic() >= deadline:
+            raise SystemExit("Device code expired before authorization. Run get_token.py again.")
+        next_poll = time.monotonic() + interval
+        token_resp = SESSION.post(
             token_url,
             data={
                 "client_id": client_id,
@@ -55,14 +97,25 @@ def main():
             timeout=30,
         )
         if token_resp.status_code == 200:
-            token_data = token_resp.json()
+            token_data = orjson.loads(token_resp.content)
             save_token(token_path, token_data)
             print(f"Token saved to {token_path}")
             print("Set TWITCH_USER_OAUTH_TOKEN to access_token from that file.")
             return
-        if token_resp.status_code in (400, 428, 429):
-            # 400 authorization_pending or slow_down in body
+        if token_resp.status_code == 429:
+            retry_after = token_resp.headers.get("Retry-After", "")
+            wait = int(retry_after) if retry_after.isdigit() else interval
+            next_poll = time.monotonic() + max(wait, interval)
             continue
+        if token_resp.status_code in (400, 428):
+            message = error_message(token_resp)
+            if message == "slow_down":
+                interval = min(interval * 2, 60)
+                next_poll = time.monotonic() + interval
+                continue
+            if message in ("authorization_pending", ""):
+                continue
+            raise SystemExit(f"Device authorization failed: {message}")
         token_resp.raise_for_status()
 
 
@@ -1,18 +1,47 @@
 #!/usr/bin/env python3
 import datetime as dt
-import json
+import optparse
 import os
 import re
-import subprocess
 import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import orjson
 import requests
+import yt_dlp
 from dotenv import load_dotenv
-from xml.sax.saxutils import escape as xml_escape
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 API_BASE = "https://api.twitch.tv/helix"
+HELIX_BATCH_SIZE = 100
+MAX_WORKERS = 16
+APP_TOKEN_MIN_TTL_SEC = 300
+TWITCH_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+VOD_FIELDS = ("id", "title", "url", "published_at", "description")
+_BAD_CHARS = re.compile(r"[\\/:*?\"<>|]+")
+NFO_HEADER = b'<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n'
+
+
+def make_session():
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "POST"),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+SESSION = make_session()
 
 
 def env(name, default=None, required=False):
@@ -23,20 +52,30 @@ def env(name, default=None, required=False):
 
 
 def load_state(path: Path):
-    if not path.exists():
+    try:
+        return orjson.loads(path.read_bytes())
+    except FileNotFoundError:
         return {"last_vod_id": None, "last_vod_published_at": None}
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+
+
+def write_atomic(path: Path, payload: bytes, mode=None):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("wb") as f:
+        if mode is not None:
+            os.fchmod(f.fileno(), mode)
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 
 def save_state(path: Path, state: dict):
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2, sort_keys=True)
+    write_atomic(path, orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
 
 
 def get_app_access_token(client_id, client_secret):
-    resp = requests.post(
+    resp = SESSION.post(
         "https://id.twitch.tv/oauth2/token",
         data={
             "client_id": client_id,
@@ -46,45 +85,84 @@ def get_app_access_token(client_id, client_secret):
         timeout=30,
     )
     resp.raise_for_status()
-    return resp.json()["access_token"]
+    return orjson.loads(resp.content)
 
 
-def twitch_get(url, token, client_id, params=None):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Client-ID": client_id,
+def load_app_token(cache_path: Path, client_id, client_secret):
+    now = time.time()
+    try:
+        cached = orjson.loads(cache_path.read_bytes())
+    except (FileNotFoundError, ValueError):
+        cached = None
+    if not isinstance(cached, dict):
+        cached = {}
+    expires_at = cached.get("expires_at")
+    if (
+        cached.get("client_id") == client_id
+        and cached.get("access_token")
+        and isinstance(expires_at, (int, float))
+        and expires_at - now > APP_TOKEN_MIN_TTL_SEC
+    ):
+        return cached["access_token"]
+
+    data = get_app_access_token(client_id, client_secret)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    payload = {
+        "access_token": data["access_token"],
+        "client_id": client_id,
+        "expires_at": int(now + data.get("expires_in", 0)),
     }
-    resp = requests.get(url, headers=headers, params=params, timeout=30)
+    write_atomic(cache_path, orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS), mode=0o600)
+    return data["access_token"]
+
+
+def twitch_get(url, params=None):
+    resp = SESSION.get(url, params=params, timeout=30)
     if resp.status_code == 401:
         raise SystemExit("Twitch API unauthorized. Check token and Client ID.")
     resp.raise_for_status()
-    return resp.json()
+    return orjson.loads(resp.content)
 
 
-def get_user_id(login, token, client_id):
-    data = twitch_get(f"{API_BASE}/users", token, client_id, params={"login": login})
-    if not data.get("data"):
-        raise SystemExit(f"No Twitch user found for login: {login}")
-    return data["data"][0]["id"]
+def chunked(values, size=HELIX_BATCH_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def get_user_ids(logins):
+    user_ids = {}
+    for batch in chunked(logins):
+        data = twitch_get(f"{API_BASE}/users", params=[("login", login) for login in batch])
+        for user in data.get("data", []):
+            user_ids[user["login"]] = user["id"]
+    return user_ids
 
 
-def get_latest_vod(user_id, token, client_id):
+def get_latest_vod(user_id):
     params = {"user_id": user_id, "first": 1, "type": "archive", "sort": "time"}
-    data = twitch_get(f"{API_BASE}/videos", token, client_id, params=params)
+    data = twitch_get(f"{API_BASE}/videos", params=params)
     if not data.get("data"):
         return None
-    return data["data"][0]
+    video = data["data"][0]
+    return {key: video.get(key) for key in VOD_FIELDS}
 
 
-def is_stream_live(user_id, token, client_id):
-    params = {"user_id": user_id}
-    data = twitch_get(f"{API_BASE}/streams", token, client_id, params=params)
-    return bool(data.get("data"))
+def prefetch_latest_vods(user_ids):
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(user_ids))) as pool:
+        return {user_id: pool.submit(get_latest_vod, user_id) for user_id in user_ids}
+
+
+def get_live_user_ids(user_ids):
+    live = set()
+    for batch in chunked(user_ids):
+        params = [("user_id", user_id) for user_id in batch] + [("first", len(batch))]
+        data = twitch_get(f"{API_BASE}/streams", params=params)
+        live.update(stream["user_id"] for stream in data.get("data", []))
+    return live
 
 
 def sanitize_filename(value):
-    value = re.sub(r"[\\/:*?\"<>|]+", "-", value)
-    value = re.sub(r"\s+", " ", value).strip()
+    value = " ".join(_BAD_CHARS.sub("-", value).split())
     return value[:180] if value else "untitled"
 
 
@@ -92,51 +170,52 @@ def season_from_date(d: dt.datetime):
     return f"Season {d.month:02d}"
 
 
-def build_paths(output_dir: Path, channel: str, show_name: str, vod_dt: dt.datetime, title: str):
+def build_show_dir(output_dir: Path, channel: str, show_name: str):
+    return output_dir / sanitize_filename(channel) / sanitize_filename(show_name)
+
+
+def build_paths(show_dir: Path, vod_dt: dt.datetime):
     season = season_from_date(vod_dt)
     base_name = f"{vod_dt:%b-%d-%H-%M}"
-    streamer_dir = output_dir / sanitize_filename(channel)
-    show_dir = streamer_dir / sanitize_filename(show_name)
     season_dir = show_dir / season
     season_dir.mkdir(parents=True, exist_ok=True)
     return season_dir, base_name, season, vod_dt
 
 
 def write_nfo(nfo_path: Path, title: str, description: str, aired: dt.date, season: int, episode: int):
-    plot = description or ""
-    title = xml_escape(title)
-    plot = xml_escape(plot)
-    nfo = f"""<?xml version="1.0" encoding="utf-8" standalone="yes"?>
-<episodedetails>
-  <title>{title}</title>
-  <plot>{plot}</plot>
-  <aired>{aired.isoformat()}</aired>
-  <season>{season}</season>
-  <episode>{episode}</episode>
-</episodedetails>
-"""
-    nfo_path.write_text(nfo, encoding="utf-8")
-
-
-def run_yt_dlp(vod_url, cookies_path, out_path: Path, extra_args):
-    cmd = [
-        "yt-dlp",
-        "--cookies",
-        cookies_path,
-        "--no-write-cookies",
-        "-o",
-        str(out_path),
-        "--merge-output-format",
-        "mp4",
-        vod_url,
-    ]
-    if extra_args:
-        cmd[1:1] = extra_args
-    subprocess.run(cmd, check=True)
+    root = ET.Element("episodedetails")
+    ET.SubElement(root, "title").text = title
+    ET.SubElement(root, "plot").text = description or ""
+    ET.SubElement(root, "aired").text = aired.isoformat()
+    ET.SubElement(root, "season").text = str(season)
+    ET.SubElement(root, "episode").text = str(episode)
+    ET.indent(root, space="  ")
+    nfo_path.write_bytes(NFO_HEADER + ET.tostring(root, encoding="utf-8", short_empty_elements=False) + b"\n")
+
+
+class ReadOnlyCookiesYoutubeDL(yt_dlp.YoutubeDL):
+    def save_cookies(self):
+        pass
+
+
+def build_ydl_opts(cookies_path, extra_args):
+    argv = [*extra_args, "--cookies", cookies_path, "--merge-output-format", "mp4"]
+    try:
+        return yt_dlp.parse_options(argv).ydl_opts
+    except optparse.OptParseError as exc:
+        raise SystemExit(f"Invalid YTDLP_EXTRA_ARGS: {exc}")
+
+
+def run_yt_dlp(vod_url, ydl_opts: dict, out_path: Path):
+    outtmpl = {**ydl_opts.get("outtmpl", {}), "default": str(out_path)}
+    with ReadOnlyCookiesYoutubeDL({**ydl_opts, "outtmpl": outtmpl}) as ydl:
+        retcode = ydl.download([vod_url])
+    if retcode:
+        raise yt_dlp.utils.DownloadError(f"yt-dlp failed for {vod_url} (exit code {retcode})")
 
 
 def normalize_channels(channels_value: str):
-    return [c.strip().lower() for c in channels_value.split(",") if c.strip()]
+    return [c for c in (value.strip().lower() for value in channels_value.split(",")) if c]
 
 
 def normalize_show_names(names_value: str):
@@ -149,60 +228,81 @@ def resolve_state_path(state_path_env: str, output_dir: Path, channel: str, mult
     base = Path(state_path_env)
     if not multi:
         return base
-    if base.exists() and base.is_dir():
+    if base.is_dir():
         return base / f"{channel}.json"
-    if base.exists() and base.is_file():
-        return base.parent / f"{channel}.json"
-    if base.suffix.lower() == ".json":
+    if base.suffix.lower() == ".json" or base.is_file():
         return base.parent / f"{channel}.json"
     return base / f"{channel}.json"
 
 
 def resolve_show_name(channel: str, index: int, show_names: list):
-    if index < len(show_names):
-        candidate = show_names[index].strip()
-        if candidate:
-            return candidate
+    if index < len(show_names) and show_names[index]:
+        return show_names[index]
     return channel
 
 
-def process_channel(
-    channel: str,
-    token: str,
-    client_id: str,
-    cookies_path: str,
-    output_dir: Path,
-    state_path: Path,
-    show_name: str,
-    extra_args: list,
-):
-    user_id = get_user_id(channel, token, client_id)
-    if is_stream_live(user_id, token, client_id):
-        print(f"{channel} is live. Skipping VOD download until stream ends.")
-        return
+def flush_log(lines: list):
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+        lines.clear()
+
+
+def parse_poll_ttl(value: str):
+    try:
+        ttl = int(value)
+    except ValueError:
+        raise SystemExit(f"Invalid VOD_POLL_TTL_SEC: {value!r} (expected whole seconds)")
+    if ttl < 0:
+        raise SystemExit(f"Invalid VOD_POLL_TTL_SEC: {value!r} (must be 0 or greater)")
+    return ttl
+
+
+def should_poll_vods(state: dict, live: bool, now: float, ttl: int):
+    if live:
+        return False
+    if state.get("last_seen_live"):
+        return True
+    return now - (state.get("last_checked_at") or 0) >= ttl
+
+
+def check_channel(channel: str, live: bool, latest: dict, state: dict, log: list):
+    if live:
+        log.append(f"{channel} is live. Skipping VOD download until stream ends.")
+        return False
 
-    latest = get_latest_vod(user_id, token, client_id)
     if not latest:
-        print(f"No VODs found for {channel}.")
-        return
+        log.append(f"No VODs found for {channel}.")
+        return False
 
-    state = load_state(state_path)
     vod_id = latest["id"]
     if state.get("last_vod_id") == vod_id:
-        print(f"No new VOD for {channel}. Latest is still {vod_id}.")
-        return
+        log.append(f"No new VOD for {channel}. Latest is still {vod_id}.")
+        return False
+    return True
 
+
+def process_channel(
+    channel: str,
+    latest: dict,
+    state: dict,
+    ydl_opts: dict,
+    show_dir: Path,
+    state_path: Path,
+    log: list,
+):
+    vod_id = latest["id"]
     vod_title = latest["title"]
     vod_url = latest["url"]
-    published_at = latest["published_at"].replace("Z", "+00:00")
-    vod_dt = dt.datetime.fromisoformat(published_at).astimezone()
+    vod_dt = dt.datetime.strptime(latest["published_at"], TWITCH_TIME_FORMAT).replace(tzinfo=dt.timezone.utc).astimezone()
 
-    season_dir, base_name, season_label, _ = build_paths(output_dir, channel, show_name, vod_dt, vod_title)
+    season_dir, base_name, season_label, _ = build_paths(show_dir, vod_dt)
     video_path = season_dir / f"{base_name}.mp4"
     nfo_path = season_dir / f"{base_name}.nfo"
 
-    print(f"Downloading VOD {vod_id} for {channel} to {video_path}...")
-    run_yt_dlp(vod_url, cookies_path, video_path, extra_args)
+    log.append(f"Downloading VOD {vod_id} for {channel} to {video_path}...")
+    flush_log(log)
+    run_yt_dlp(vod_url, ydl_opts, video_path)
 
     season_num = int(season_label.split()[-1])
     episode_num = vod_dt.day
@@ -211,7 +311,7 @@ def process_channel(
     state["last_vod_id"] = vod_id
     state["last_vod_published_at"] = latest["published_at"]
     save_state(state_path, state)
-    print(f"Done for {channel}. Updated state in {state_path}.")
+    log.append(f"Done for {channel}. Updated state in {state_path}.")
 
 
 def main():
@@ -226,7 +326,11 @@ def main():
         raise SystemExit("No valid channels provided.")
 
     show_names_value = env("SHOW_NAMES", default="")
-    show_names = normalize_show_names(show_names_value)
+    show_name_value = env("SHOW_NAME", default="")
+    if show_names_value:
+        show_names = normalize_show_names(show_names_value)
+    else:
+        show_names = [show_name_value.strip()] if show_name_value else []
 
     client_id = env("TWITCH_CLIENT_ID", required=True)
     client_secret = env("TWITCH_CLIENT_SECRET", required=True)
@@ -234,37 +338,98 @@ def main():
     cookies_path = env("COOKIES_PATH", required=True)
     output_dir = Path(env("OUTPUT_DIR", required=True))
     state_path_env = env("STATE_PATH", default="")
+    token_cache_env = env("APP_TOKEN_CACHE_PATH", default="")
     extra_args = env("YTDLP_EXTRA_ARGS", default="").split()
+    vod_poll_ttl = parse_poll_ttl(env("VOD_POLL_TTL_SEC", default="900"))
 
     if not Path(cookies_path).exists():
         raise SystemExit(f"Cookies file not found: {cookies_path}")
+    ydl_opts = build_ydl_opts(cookies_path, extra_args)
 
+    token_cache_path = None
     if user_token:
         token = user_token
     else:
-        token = get_app_access_token(client_id, client_secret)
+        token_cache_path = Path(token_cache_env) if token_cache_env else output_dir / "state" / "_app_token.json"
+        token = load_app_token(token_cache_path, client_id, client_secret)
+    SESSION.headers.update({"Authorization": f"Bearer {token}", "Client-ID": client_id})
+
+    try:
+        user_ids = get_user_ids(channels)
+    except SystemExit:
+        if token_cache_path:
+            token_cache_path.unlink(missing_ok=True)
+        raise
+    live_user_ids = get_live_user_ids(list(user_ids.values()))
 
     multi = len(channels) > 1
+    now = time.time()
+    log = []
+    jobs = []
+    seen = set()
     for index, channel in enumerate(channels):
-        show_name = resolve_show_name(channel, index, show_names)
+        if channel in seen:
+            continue
+        seen.add(channel)
+        user_id = user_ids.get(channel)
+        if not user_id:
+            log.append(f"No Twitch user found for login: {channel}")
+            continue
+        show_dir = build_show_dir(output_dir, channel, resolve_show_name(channel, index, show_names))
         state_path = resolve_state_path(state_path_env, output_dir, channel, multi)
         try:
-            process_channel(
-                channel=channel,
-                token=token,
-                client_id=client_id,
-                cookies_path=cookies_path,
-                output_dir=output_dir,
-                state_path=state_path,
-                show_name=show_name,
-                extra_args=extra_args,
-            )
+            state = load_state(state_path)
         except Exception as exc:
-            print(f"Error processing {channel}: {exc}")
+            log.append(f"Error processing {channel}: {exc}")
+            continue
+        jobs.append((channel, user_id, show_dir, state_path, state))
+
+    poll_ids = [
+        user_id
+        for _, user_id, _, _, state in jobs
+        if should_poll_vods(state, user_id in live_user_ids, now, vod_poll_ttl)
+    ]
+
+    try:
+        vod_futures = prefetch_latest_vods(poll_ids) if len(poll_ids) > 1 else {}
+        for channel, user_id, show_dir, state_path, state in jobs:
+            try:
+                live = user_id in live_user_ids
+                if live:
+                    latest = None
+                elif user_id in vod_futures:
+                    latest = vod_futures[user_id].result()
+                elif user_id in poll_ids:
+                    latest = get_latest_vod(user_id)
+                else:
+                    log.append(f"{channel} is offline and was checked less than {vod_poll_ttl}s ago. Skipping.")
+                    continue
+                checked = {"last_seen_live": True} if live else {"last_seen_live": False, "last_checked_at": int(now)}
+                changed = any(state.get(key) != value for key, value in checked.items())
+                state.update(checked)
+                if not check_channel(channel, live, latest, state, log):
+                    if changed:
+                        save_state(state_path, state)
+                    continue
+                process_channel(
+                    channel=channel,
+                    latest=latest,
+                    state=state,
+                    ydl_opts=ydl_opts,
+                    show_dir=show_dir,
+                    state_path=state_path,
+                    log=log,
+                )
+            except Exception as exc:
+                log.append(f"Error processing {channel}: {exc}")
+            finally:
+                flush_log(log)
+    finally:
+        flush_log(log)
 
 
 if __name__ == "__main__":
     try:
         main()
-    except subprocess.CalledProcessError as e:
-        sys.exit(e.returncode)
+    except yt_dlp.utils.DownloadError:
+        sys.exit(1)